@@ -51,10 +51,16 @@ STABLE.
 import gettext
 import logging
 import os
+import errno
+import fcntl
 import time
+import ctypes
+import struct
 from hashlib import sha1
 from functools import partial
+from collections import namedtuple
 import json
+from datetime import datetime
 
 import gconf
 import gtk
@@ -71,6 +77,7 @@ from telepathy.interfaces import CHANNEL, \
 from telepathy.constants import CONNECTION_HANDLE_TYPE_CONTACT
 from telepathy.constants import CONNECTION_HANDLE_TYPE_ROOM
 
+from sugar import env
 from sugar import util
 from sugar.presence import presenceservice
 from sugar.activity import i18n
@@ -102,6 +109,26 @@ POWERD_INHIBIT_DIR = '/var/run/powerd-inhibit-suspend'
 
 CONN_INTERFACE_ACTIVITY_PROPERTIES = 'org.laptop.Telepathy.ActivityProperties'
 
+HARVEST_GCONF_DIR = '/desktop/sugar/collaboration/'
+
+# Sessions kept at full resolution, older ones are folded into one rollup
+# per period (in seconds) and rollups beyond the maximum into the oldest.
+# Folded sessions leave 'launch-times' and 'spent-times', and are only
+# counted in 'session-rollups'.
+SESSION_RECENT_DEFAULT = 64
+SESSION_ROLLUP_PERIOD_DEFAULT = 86400
+SESSION_ROLLUPS_MAX = 128
+
+# Seconds to wait before writing the spent time after losing focus
+SAVE_DELAY_DEFAULT = 30
+
+# Journal preview encoding: 'png' uses the full ARGB32 encoder, 'fast'
+# drops the alpha channel and uses a low zlib level, 'half' also renders
+# the preview at half size.
+PREVIEW_FORMAT_DEFAULT = 'png'
+PREVIEW_FORMATS = ('png', 'fast', 'half')
+PREVIEW_FAST_COMPRESSION = 1
+
 
 gconf_client  = gconf.client_get_default()
 GCONF_FOR_ACTIVITIES_NOT_REQUIRING_OSK_ACCUMULATION = \
@@ -115,16 +142,40 @@ if GCONF_FOR_ACTIVITIES_NOT_REQUIRING_OSK_ACCUMULATION is not None:
 
 DCON_SLEEP_PATH = '/sys/devices/platform/dcon/sleep'
 
-class SuspendMonitor():
+class SuspendMonitor(object):
+    """Watches the DCON sleep state and tells the subscribed activities
+    when the display sleeps or wakes up.
 
-    def __init__(self, activity):
-        self._activity = activity
-        self._is_suspended = None
+    There is one monitor per process, and every activity runs in its own
+    process, so each activity still has its own file monitor. What it saves
+    is the monitor setup during startup: it is done when idle, and not at
+    all on laptops without a DCON."""
 
+    def __init__(self):
+        self._activities = []
+        self._is_suspended = False
+        self._monitor = None
+
+        # Not every laptop has a DCON, and activity startup shouldn't pay
+        # for the monitor setup.
+        if os.path.exists(DCON_SLEEP_PATH):
+            gobject.idle_add(self.__start_monitor_cb)
+
+    def __start_monitor_cb(self):
         self._monitor = gio.File(DCON_SLEEP_PATH)\
                            .monitor_file(gio.FILE_MONITOR_NONE, None)
 
         self._monitor.connect('changed', self._file_changed_cb)
+        return False
+
+    def subscribe(self, activity):
+        self._activities.append(activity)
+        if self._is_suspended:
+            activity._set_suspended(True)
+
+    def unsubscribe(self, activity):
+        if activity in self._activities:
+            self._activities.remove(activity)
 
     def _file_changed_cb(self, monitor, one_file, other_file, event):
         if event != gio.FILE_MONITOR_EVENT_CHANGED:
@@ -137,7 +188,305 @@ class SuspendMonitor():
             return
         self._is_suspended = is_suspended
 
-        self._activity.set_active(not is_suspended)
+        for activity in self._activities[:]:
+            activity._set_suspended(is_suspended)
+
+
+_suspend_monitor = None
+
+
+def _get_suspend_monitor():
+    global _suspend_monitor
+
+    if _suspend_monitor is None:
+        _suspend_monitor = SuspendMonitor()
+
+    return _suspend_monitor
+
+
+CLOCK_MONOTONIC = 1
+
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+def _get_clock_gettime():
+    try:
+        clock_gettime = ctypes.CDLL('librt.so.1').clock_gettime
+    except (OSError, AttributeError):
+        logging.warning('clock_gettime() not available, the spent time '
+                        'will follow the wall clock')
+        return None
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+    return clock_gettime
+
+_clock_gettime = _get_clock_gettime()
+
+
+def _monotonic_time():
+    """Returns seconds from an arbitrary point that are not affected by
+    changes to the wall clock and do not advance while suspended"""
+    if _clock_gettime is None:
+        return time.time()
+    timespec = _Timespec()
+    if _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(timespec)) != 0:
+        return time.time()
+    return timespec.tv_sec + timespec.tv_nsec * 1e-9
+
+
+def _get_harvest_option(option, default):
+    """Returns a harvest setting from GConf, or default if it is not set"""
+    value = gconf.client_get_default().get(HARVEST_GCONF_DIR + 'harvest_' + option)
+    if value is None:
+        return default
+    if isinstance(default, bool):
+        return value.get_bool()
+    elif isinstance(default, int):
+        return value.get_int()
+    else:
+        return value.get_string()
+
+
+class _SessionLog(object):
+    """Launch and spent times of the recent sessions of a journal object.
+
+    They are kept in the comma separated 'launch-times' and 'spent-times'
+    metadata entries that the harvest collector reads. Adding a session
+    appends to both strings and updating the spent time of the last one
+    only replaces the text after the last comma, neither parses the
+    sessions already recorded.
+
+    Older sessions are folded by compact() into rollups of the first and
+    last launch timestamps, the number of sessions and the total seconds
+    spent, stored as JSON in the 'session-rollups' metadata entry.
+    """
+
+    def __init__(self, launch_times='', spent_times='', rollups=None):
+        self._launch_times = launch_times
+        self._spent_times = spent_times
+        self._count = _count_times(launch_times)
+        if _count_times(spent_times) != self._count:
+            spent_times = _parse_times(spent_times)[:self._count]
+            spent_times += [0] * (self._count - len(spent_times))
+            self._spent_times = ', '.join('%d' % spent_time
+                                          for spent_time in spent_times)
+        self._rollups = rollups or []
+        self._rollups_changed = False
+
+    @classmethod
+    def from_metadata(cls, metadata):
+        try:
+            rollups = [tuple(rollup) for rollup in
+                       json.loads(metadata.get('session-rollups', '[]'))]
+        except ValueError:
+            rollups = []
+        return cls(str(metadata.get('launch-times', '')),
+                   str(metadata.get('spent-times', '')), rollups)
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        return iter(zip(_parse_times(self._launch_times),
+                        _parse_times(self._spent_times)))
+
+    def append(self, launch_time, spent_time=0):
+        if self._count:
+            self._launch_times += ', %d' % launch_time
+            self._spent_times += ', %d' % spent_time
+        else:
+            self._launch_times = '%d' % launch_time
+            self._spent_times = '%d' % spent_time
+        self._count += 1
+
+    def set_last_spent_time(self, spent_time):
+        if not self._count:
+            return
+        head, separator, last_ = self._spent_times.rpartition(', ')
+        self._spent_times = '%s%s%d' % (head, separator, spent_time)
+
+    def get_rollups(self):
+        return list(self._rollups)
+
+    def compact(self, recent, period, max_rollups):
+        """Folds all but the last recent sessions into one rollup per
+        period, and the rollups beyond max_rollups into the oldest one."""
+        excess = len(self) - max(recent, 1)
+        if excess <= 0:
+            return
+
+        sessions = list(self)
+        for launch_time, spent_time in sessions[:excess]:
+            self._add_to_rollup(launch_time, spent_time, max(period, 1))
+        sessions = sessions[excess:]
+        self._launch_times = ', '.join('%d' % launch_time
+                                       for launch_time, spent_ in sessions)
+        self._spent_times = ', '.join('%d' % spent_time
+                                      for launch_, spent_time in sessions)
+        self._count = len(sessions)
+
+        while len(self._rollups) > max(max_rollups, 1):
+            merged = _merge_rollups(self._rollups[0], self._rollups[1])
+            self._rollups[:2] = [merged]
+        self._rollups_changed = True
+
+    def _add_to_rollup(self, launch_time, spent_time, period):
+        rollup = (launch_time, launch_time, 1, spent_time)
+        if self._rollups:
+            last = self._rollups[-1]
+            if last[0] / period == launch_time / period:
+                self._rollups[-1] = _merge_rollups(last, rollup)
+                return
+        self._rollups.append(rollup)
+
+    def get_legacy_times(self):
+        """Returns the launch and spent times of the recent sessions as
+        comma separated strings."""
+        return self._launch_times, self._spent_times
+
+    def write_metadata(self, metadata):
+        metadata['launch-times'] = self._launch_times
+        metadata['spent-times'] = self._spent_times
+        if self._rollups_changed:
+            metadata['session-rollups'] = json.dumps(self._rollups)
+            self._rollups_changed = False
+
+
+def _parse_times(times):
+    return [int(value) for value in times.split(',') if value.strip()]
+
+
+def _count_times(times):
+    if not times.strip():
+        return 0
+    return times.count(',') + 1
+
+
+def _uint32(value):
+    return min(max(int(value), 0), 0xffffffff)
+
+
+def _merge_rollups(first, second):
+    return (min(first[0], second[0]), max(first[1], second[1]),
+            _uint32(first[2] + second[2]), _uint32(first[3] + second[3]))
+
+
+def get_session_times(metadata):
+    """Returns the 'launch-times' and 'spent-times' of a journal object as
+    comma separated strings. They only have the recent sessions, see
+    get_session_totals() for all of them."""
+    return _SessionLog.from_metadata(metadata).get_legacy_times()
+
+
+def get_session_totals(metadata):
+    """Returns the number of sessions and the seconds spent in all the
+    sessions of a journal object, including the ones folded into rollups."""
+    session_log = _SessionLog.from_metadata(metadata)
+    launches = len(session_log)
+    spent_time = sum(spent for launch_, spent in session_log)
+    for first_, last_, count, total in session_log.get_rollups():
+        launches += count
+        spent_time += total
+    return launches, spent_time
+
+
+# Finished sessions are kept for the harvest collector in a ring buffer:
+# a header with the magic, the capacity and the next sequence number,
+# followed by fixed size records, each one stored at seq % capacity.
+SESSION_RECORDS_NAME = 'harvest-sessions'
+SESSION_RECORDS_MAGIC = 'HCSESS01'
+SESSION_RECORDS_CAPACITY = 1024
+SESSION_RECORDS_HEADER = struct.Struct('<8sII')
+SESSION_RECORD_ENTRY = struct.Struct('<IIIIB3x40s68s')
+SESSION_END_REASONS = ['close', 'quit']
+
+SessionRecord = namedtuple('SessionRecord', ['seq', 'start', 'end', 'active',
+                                             'reason', 'activity_id',
+                                             'bundle_id'])
+
+
+def _read_session_records_header(records_file):
+    records_file.seek(0)
+    header = records_file.read(SESSION_RECORDS_HEADER.size)
+    if len(header) < SESSION_RECORDS_HEADER.size:
+        return None
+    magic, capacity, next_seq = SESSION_RECORDS_HEADER.unpack(header)
+    if magic != SESSION_RECORDS_MAGIC or capacity == 0:
+        return None
+    return capacity, next_seq
+
+
+def write_session_record(start, end, active, reason, activity_id, bundle_id,
+                         path=None):
+    """Appends a finished session to the ring buffer, overwriting the oldest
+    record once it is full. reason is one of SESSION_END_REASONS."""
+    if path is None:
+        path = env.get_profile_path(SESSION_RECORDS_NAME)
+
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+    with os.fdopen(fd, 'r+b') as records_file:
+        fcntl.lockf(records_file, fcntl.LOCK_EX)
+        try:
+            header = _read_session_records_header(records_file)
+            if header is None:
+                capacity, seq = SESSION_RECORDS_CAPACITY, 0
+            else:
+                capacity, seq = header
+
+            records_file.seek(SESSION_RECORDS_HEADER.size +
+                              (seq % capacity) * SESSION_RECORD_ENTRY.size)
+            records_file.write(SESSION_RECORD_ENTRY.pack(
+                seq, _uint32(start), _uint32(end), _uint32(active),
+                SESSION_END_REASONS.index(reason), str(activity_id),
+                str(bundle_id)))
+            # The record only counts once the header points past it
+            records_file.seek(0)
+            records_file.write(SESSION_RECORDS_HEADER.pack(
+                SESSION_RECORDS_MAGIC, capacity, seq + 1))
+            records_file.flush()
+        finally:
+            fcntl.lockf(records_file, fcntl.LOCK_UN)
+
+
+def read_session_records(since_seq=0, path=None):
+    """Returns the SessionRecords still in the ring buffer with a sequence
+    number of at least since_seq, oldest first. Collectors keep the last
+    seq they got and pass seq + 1 on the next run."""
+    if path is None:
+        path = env.get_profile_path(SESSION_RECORDS_NAME)
+
+    try:
+        records_file = open(path, 'rb')
+    except IOError, e:
+        if e.errno == errno.ENOENT:
+            return []
+        raise
+
+    with records_file:
+        fcntl.lockf(records_file, fcntl.LOCK_SH)
+        try:
+            header = _read_session_records_header(records_file)
+            if header is None:
+                return []
+            capacity, next_seq = header
+            data = records_file.read(capacity * SESSION_RECORD_ENTRY.size)
+        finally:
+            fcntl.lockf(records_file, fcntl.LOCK_UN)
+
+    records = []
+    for seq in xrange(max(since_seq, next_seq - capacity, 0), next_seq):
+        offset = (seq % capacity) * SESSION_RECORD_ENTRY.size
+        if offset + SESSION_RECORD_ENTRY.size > len(data):
+            continue
+        entry = SESSION_RECORD_ENTRY.unpack_from(data, offset)
+        if entry[0] != seq or entry[4] >= len(SESSION_END_REASONS):
+            continue
+        records.append(SessionRecord(seq, entry[1], entry[2], entry[3],
+                                     SESSION_END_REASONS[entry[4]],
+                                     entry[5].rstrip('\0'),
+                                     entry[6].rstrip('\0')))
+    return records
 
 
 class _ActivitySession(gobject.GObject):
@@ -309,7 +658,6 @@ class Activity(Window, gtk.Container):
         settings.set_property('gtk-font-name',
                               '%s %f' % (style.FONT_FACE, style.FONT_SIZE))
 
-        monitor = SuspendMonitor(self)
         Window.__init__(self)
 
         if 'SUGAR_ACTIVITY_ROOT' in os.environ:
@@ -333,17 +681,32 @@ class Activity(Window, gtk.Container):
 
         self._active = False
         self._active_time = None
+        self._launch_time = int(time.time())
+        self._session_recorded = False
+        self._suspended = False
+        self._active_before_suspend = False
         self._spent_time = 0
+        _get_suspend_monitor().subscribe(self)
         self._activity_id = handle.activity_id
         self.shared_activity = None
+        self._buddies = {}
+        self._buddies_dirty = False
         self._join_id = None
         self._updating_jobject = False
+        self._creating_jobject = False
+        self._saving_spent_time = False
+        self._save_requested = False
+        self._spent_time_save_sid = None
+        self._preview = None
+        self._preview_damaged = True
+        self._rendering_preview = False
         self._closing = False
         self._quit_requested = False
         self._deleting = False
         self._max_participants = 0
         self._invites_queue = []
         self._jobject = None
+        self._session_log = None
         self._read_file_called = False
 
         self._session = _get_session()
@@ -367,17 +730,16 @@ class Activity(Window, gtk.Container):
             if 'share-scope' in self._jobject.metadata:
                 share_scope = self._jobject.metadata['share-scope']
 
-            if 'launch-times' in self._jobject.metadata:
-                self._jobject.metadata['launch-times'] += ', %d' % \
-                    int(time.time())
-            else:
-                self._jobject.metadata['launch-times'] = \
-                    str(int(time.time()))
-
-            if 'spent-times' in self._jobject.metadata:
-                self._jobject.metadata['spent-times'] += ', 0'
-            else:
-                self._jobject.metadata['spent-times'] = '0'
+            self._session_log = \
+                _SessionLog.from_metadata(self._jobject.metadata)
+            self._session_log.append(self._launch_time)
+            self._session_log.compact(
+                _get_harvest_option('session_recent',
+                                    SESSION_RECENT_DEFAULT),
+                _get_harvest_option('session_rollup',
+                                    SESSION_ROLLUP_PERIOD_DEFAULT),
+                SESSION_ROLLUPS_MAX)
+            self._session_log.write_metadata(self._jobject.metadata)
 
         self.shared_activity = None
         self._join_id = None
@@ -431,14 +793,24 @@ class Activity(Window, gtk.Container):
         jobject.metadata['preview'] = ''
         jobject.metadata['share-scope'] = SCOPE_PRIVATE
         jobject.metadata['icon-color'] = icon_color
-        jobject.metadata['launch-times'] = str(int(time.time()))
-        jobject.metadata['spent-times'] = '0'
+        self._session_log = _SessionLog()
+        self._session_log.append(self._launch_time)
+        self._session_log.write_metadata(jobject.metadata)
+        # Set by datastore.write(), which is not used for the create
+        jobject.metadata['mtime'] = datetime.now().isoformat()
+        jobject.metadata['timestamp'] = int(time.time())
         jobject.file_path = ''
 
-        # FIXME: We should be able to get an ID synchronously from the DS,
-        # then call async the actual create.
+        # datastore.write() can only create synchronously, so ask the data
+        # store directly and fill in the ID when it replies. Saves done in
+        # the meantime are queued until then.
         # http://bugs.sugarlabs.org/ticket/2169
-        datastore.write(jobject)
+        self._updating_jobject = True
+        self._creating_jobject = True
+        datastore._get_data_store().create(
+            dbus.Dictionary(jobject.metadata.get_dictionary()), '', False,
+            reply_handler=self.__jobject_create_cb,
+            error_handler=self.__jobject_error_cb)
 
         return jobject
 
@@ -499,18 +871,41 @@ class Activity(Window, gtk.Container):
         return self._active
 
     def _update_spent_time(self, active):
+        """Closes the current active segment, if any, and opens a new one
+        if active. Segments are measured with the monotonic clock, the wall
+        clock is only used for the session start times."""
+        now = _monotonic_time()
+        if self._active_time is not None:
+            # The fallback wall clock may go backwards
+            self._spent_time += max(now - self._active_time, 0)
         if active:
-            self._active_time = time.time()
+            self._active_time = now
         else:
-            self._spent_time += time.time() - self._active_time
             self._active_time = None
 
     def set_active(self, active):
+        if self._suspended:
+            # Applied on wake up, see _set_suspended()
+            self._active_before_suspend = active
+            return
         if self._active != active:
             self._active = active
             self._update_spent_time(self._active)
             if not self._active and self._jobject:
-                self.save()
+                self._schedule_spent_time_save()
+
+    def _set_suspended(self, suspended):
+        """Closes the active segment when the display goes to sleep and
+        opens a new one on wake up only if the activity was active before"""
+        if suspended == self._suspended:
+            return
+        if suspended:
+            self._active_before_suspend = self._active
+            self.set_active(False)
+            self._suspended = True
+        else:
+            self._suspended = False
+            self.set_active(self._active_before_suspend)
 
     active = gobject.property(
         type=bool, default=False, getter=get_active, setter=set_active)
@@ -552,6 +947,9 @@ class Activity(Window, gtk.Container):
         Window.set_canvas(self, canvas)
         if not self._read_file_called:
             canvas.connect('map', self.__canvas_map_cb)
+        canvas.connect('size-allocate', self.__canvas_size_allocate_cb)
+        self._hook_preview_damage(canvas)
+        self._preview_damaged = True
 
     canvas = property(get_canvas, set_canvas)
 
@@ -587,6 +985,26 @@ class Activity(Window, gtk.Container):
     def __session_quit_cb(self, client):
         self._complete_close()
 
+    def _hook_preview_damage(self, widget):
+        """Marks the preview as damaged when the canvas is redrawn, and
+        when any of its descendants with their own window is, since those
+        are exposed without the canvas."""
+        if widget is self.canvas or widget.get_has_window():
+            if not getattr(widget, '_preview_damage_hooked', False):
+                widget.connect('expose-event', self.__widget_expose_cb)
+                widget._preview_damage_hooked = True
+        if isinstance(widget, gtk.Container):
+            widget.forall(self._hook_preview_damage)
+
+    def __widget_expose_cb(self, widget, event):
+        if not self._rendering_preview:
+            self._preview_damaged = True
+        return False
+
+    def __canvas_size_allocate_cb(self, canvas, allocation):
+        # Adding children allocates the canvas again, hook the new ones
+        self._hook_preview_damage(canvas)
+
     def __canvas_map_cb(self, canvas):
         logging.debug('Activity.__canvas_map_cb')
         if self._jobject and self._jobject.file_path and \
@@ -595,11 +1013,24 @@ class Activity(Window, gtk.Container):
             self._read_file_called = True
         canvas.disconnect_by_func(self.__canvas_map_cb)
 
-    def __jobject_create_cb(self):
-        pass
+    def __jobject_create_cb(self, object_id):
+        logging.debug('Activity datastore object created: %s', object_id)
+        self._jobject.object_id = object_id
+        self.__jobject_created()
 
     def __jobject_error_cb(self, err):
         logging.debug('Error creating activity datastore object: %s', err)
+        # Fall back to the synchronous create
+        try:
+            datastore.write(self._jobject)
+        except dbus.DBusException:
+            logging.exception('Error creating activity datastore object')
+        self.__jobject_created()
+
+    def __jobject_created(self):
+        self._updating_jobject = False
+        self._creating_jobject = False
+        self._finish_pending_save()
 
     def get_activity_root(self):
         """ FIXME: Deprecated. This part of the API has been moved
@@ -661,6 +1092,90 @@ class Activity(Window, gtk.Container):
         """
         raise NotImplementedError
 
+    def _get_spent_time(self):
+        if self._active_time is None:
+            return self._spent_time
+        return self._spent_time + max(_monotonic_time() - self._active_time, 0)
+
+    def _schedule_spent_time_save(self):
+        """Coalesces the spent time updates done when the activity loses
+        focus into one metadata-only write after a delay. Closing and
+        quitting still do a full save()."""
+        if self._spent_time_save_sid is not None:
+            return
+        delay = _get_harvest_option('save_delay', SAVE_DELAY_DEFAULT)
+        self._spent_time_save_sid = gobject.timeout_add_seconds(
+            delay, self.__spent_time_save_timeout_cb)
+
+    def _cancel_spent_time_save(self):
+        if self._spent_time_save_sid is not None:
+            gobject.source_remove(self._spent_time_save_sid)
+            self._spent_time_save_sid = None
+
+    def __spent_time_save_timeout_cb(self):
+        self._spent_time_save_sid = None
+        self._save_spent_time()
+        return False
+
+    def _save_spent_time(self):
+        """Writes the spent time to the datastore, without rendering a
+        preview nor calling write_file()."""
+        if self._jobject is None or self._session_log is None:
+            return
+
+        if self._updating_jobject:
+            self._schedule_spent_time_save()
+            return
+
+        if self._jobject.object_id is None:
+            return
+
+        self._session_log.set_last_spent_time(self._get_spent_time())
+        self._session_log.write_metadata(self.metadata)
+
+        # Update the metadata only, an empty file path leaves the current
+        # file in the datastore. The journal object and the file it owns
+        # are not touched.
+        self._updating_jobject = True
+        self._saving_spent_time = True
+        datastore._get_data_store().update(
+            str(self._jobject.object_id),
+            dbus.Dictionary(self.metadata.get_dictionary()), '', False,
+            reply_handler=self.__spent_time_save_cb,
+            error_handler=self.__spent_time_save_error_cb)
+
+    def __spent_time_save_cb(self):
+        self._updating_jobject = False
+        self._saving_spent_time = False
+        self._finish_pending_save()
+
+    def __spent_time_save_error_cb(self, err):
+        logging.error('Error saving the spent time to the datastore: %s', err)
+        self.__spent_time_save_cb()
+
+    def _finish_pending_save(self):
+        """Runs the save() queued while the datastore was busy, and then
+        completes the close or quit that was waiting for it."""
+        if self._save_requested:
+            self._save_requested = False
+            try:
+                self.save()
+            except:
+                # pylint: disable=W0702
+                logging.exception('Error saving activity object to datastore')
+                if self._closing:
+                    self._closing = False
+                    self._show_keep_failed_dialog()
+                return
+
+        if self._updating_jobject:
+            # __save_cb completes the close or quit
+            return
+        if self._quit_requested:
+            self._session.will_quit(self, True)
+        elif self._closing:
+            self._complete_close()
+
     def __save_cb(self):
         logging.debug('Activity.__save_cb')
         self._updating_jobject = False
@@ -706,29 +1221,35 @@ class Activity(Window, gtk.Container):
         pixbuf = gtk.gdk.Pixbuf(gtk.gdk.COLORSPACE_RGB, 0, 8, width, height)
         pixbuf = pixbuf.get_from_drawable(pixmap, pixmap.get_colormap(),
                                           0, 0, 0, 0, width, height)
-        pixbuf = pixbuf.scale_simple(style.zoom(300), style.zoom(225),
-                                     gtk.gdk.INTERP_BILINEAR)
-
-        preview_data = []
-
-        def save_func(buf, data):
-            data.append(buf)
-
-        pixbuf.save_to_callback(save_func, 'png', user_data=preview_data)
-        preview_data = ''.join(preview_data)
-
-        return preview_data
+        preview_format = _get_harvest_option('preview_format',
+                                             PREVIEW_FORMAT_DEFAULT)
+        return render_preview(pixbuf, preview_format)
 
     def _get_buddies(self):
-        if self.shared_activity is not None:
-            buddies = {}
-            for buddy in self.shared_activity.get_joined_buddies():
-                if not buddy.props.owner:
-                    buddy_id = sha1(buddy.props.key).hexdigest()
-                    buddies[buddy_id] = [buddy.props.nick, buddy.props.color]
-            return buddies
-        else:
-            return {}
+        return dict(self._buddies)
+
+    def _track_buddies(self):
+        """Fills the buddy cache from the shared activity and keeps it up
+        to date with its buddy-joined and buddy-left signals, so saving
+        doesn't walk the joined buddies each time."""
+        self._buddies = {}
+        self._buddies_dirty = True
+        for buddy in self.shared_activity.get_joined_buddies():
+            self.__buddy_joined_cb(self.shared_activity, buddy)
+        self.shared_activity.connect('buddy-joined', self.__buddy_joined_cb)
+        self.shared_activity.connect('buddy-left', self.__buddy_left_cb)
+
+    def __buddy_joined_cb(self, shared_activity, buddy):
+        if not buddy.props.owner:
+            buddy_id = sha1(buddy.props.key).hexdigest()
+            self._buddies[buddy_id] = [buddy.props.nick, buddy.props.color]
+            self._buddies_dirty = True
+
+    def __buddy_left_cb(self, shared_activity, buddy):
+        if not buddy.props.owner:
+            buddy_id = sha1(buddy.props.key).hexdigest()
+            if self._buddies.pop(buddy_id, None) is not None:
+                self._buddies_dirty = True
 
     def save(self):
         """Request that the activity is saved to the Journal.
@@ -746,31 +1267,42 @@ class Activity(Window, gtk.Container):
         logging.debug('Activity.save: %r', self._jobject.object_id)
 
         if self._updating_jobject:
+            if self._saving_spent_time or self._creating_jobject:
+                # Save again once the spent time is written or the journal
+                # object is created
+                self._save_requested = True
             logging.info('Activity.save: still processing a previous request.')
             return
 
-        buddies_dict = self._get_buddies()
-        if buddies_dict:
-            self.metadata['buddies_id'] = json.dumps(buddies_dict.keys())
-            self.metadata['buddies'] = json.dumps(self._get_buddies())
+        self._cancel_spent_time_save()
 
-        # Accumulate the last spent time.
-        if self._active:
-            self._update_spent_time(False)
+        if self._buddies_dirty and self._buddies:
+            self.metadata['buddies_id'] = json.dumps(self._buddies.keys())
+            self.metadata['buddies'] = json.dumps(self._buddies)
+        self._buddies_dirty = False
 
-        def set_last_value(values_list, new_value):
-            if ', ' not in values_list:
-                return '%d' % new_value
-            else:
-                partial_list = ', '.join(values_list.split(', ')[:-1])
-                return partial_list + ', %d' % new_value
+        # Accumulate the last spent time, and keep counting if still active.
+        self._update_spent_time(self._active)
 
-        self.metadata['spent-times'] = set_last_value(
-            self.metadata['spent-times'], self._spent_time)
+        if self._session_log is not None:
+            self._session_log.set_last_spent_time(self._spent_time)
+            self._session_log.write_metadata(self.metadata)
 
-        preview = self.get_preview()
-        if preview is not None:
-            self.metadata['preview'] = dbus.ByteArray(preview)
+        # Only render a new preview if the canvas or one of its child
+        # windows was redrawn since the last one.
+        if self._preview_damaged:
+            self._rendering_preview = True
+            try:
+                preview = self.get_preview()
+            finally:
+                self._rendering_preview = False
+            self._preview_damaged = False
+            if preview is not None:
+                self._preview = dbus.ByteArray(preview)
+            else:
+                self._preview = None
+        if self._preview is not None:
+            self.metadata['preview'] = self._preview
 
         if not self.metadata.get('activity_id', ''):
             self.metadata['activity_id'] = self.get_id()
@@ -841,6 +1373,7 @@ class Activity(Window, gtk.Container):
         self.reveal()
         self.emit('joined')
         self.__privacy_changed_cb(self.shared_activity, None)
+        self._track_buddies()
 
     def get_shared_activity(self):
         """Returns an instance of the shared Activity or None
@@ -873,6 +1406,7 @@ class Activity(Window, gtk.Container):
                 self.__privacy_changed_cb)
         self.emit('shared')
         self.__privacy_changed_cb(self.shared_activity, None)
+        self._track_buddies()
 
         self._send_invites()
 
@@ -958,7 +1492,9 @@ class Activity(Window, gtk.Container):
         return True
 
     def _prepare_close(self, skip_save=False):
-        if not skip_save:
+        if skip_save:
+            self._save_requested = False
+        else:
             try:
                 self.save()
             except:
@@ -971,7 +1507,26 @@ class Activity(Window, gtk.Container):
 
         return True
 
+    def _write_session_record(self):
+        if self._session_recorded:
+            return
+        self._session_recorded = True
+
+        if self._quit_requested:
+            reason = 'quit'
+        else:
+            reason = 'close'
+        try:
+            write_session_record(self._launch_time, int(time.time()),
+                                 self._get_spent_time(), reason,
+                                 self._activity_id, self.get_bundle_id())
+        except (IOError, OSError):
+            logging.exception('Error writing the session record')
+
     def _complete_close(self):
+        self._cancel_spent_time_save()
+        self._write_session_record()
+        _get_suspend_monitor().unsubscribe(self)
         self.destroy()
 
         if self.shared_activity:
@@ -1105,6 +1660,32 @@ def _get_session():
     return _session
 
 
+def render_preview(pixbuf, preview_format=PREVIEW_FORMAT_DEFAULT):
+    """Scales a snapshot of the canvas to the preview size and returns it
+    encoded as png according to preview_format, one of PREVIEW_FORMATS.
+    """
+    if preview_format not in PREVIEW_FORMATS:
+        preview_format = PREVIEW_FORMAT_DEFAULT
+
+    preview_width, preview_height = style.zoom(300), style.zoom(225)
+    if preview_format == 'half':
+        preview_width, preview_height = preview_width / 2, preview_height / 2
+    pixbuf = pixbuf.scale_simple(preview_width, preview_height,
+                                 gtk.gdk.INTERP_BILINEAR)
+
+    options = {}
+    if preview_format != 'png':
+        options['compression'] = str(PREVIEW_FAST_COMPRESSION)
+
+    preview_data = []
+
+    def save_func(buf, data):
+        data.append(buf)
+
+    pixbuf.save_to_callback(save_func, 'png', options, preview_data)
+    return ''.join(preview_data)
+
+
 def get_bundle_name():
     """Return the bundle name for the current process' bundle"""
     return os.environ['SUGAR_BUNDLE_NAME']